@@ -1,28 +1,128 @@
 import streamlit as st
 import pandas as pd
 import smtplib
-from pymongo import MongoClient
+from pymongo import MongoClient, WriteConcern
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.server_api import ServerApi
+import bcrypt
+import hmac
 from email.message import EmailMessage
 from email_validator import validate_email, EmailNotValidError
-import random
 import io
+import os
+import tempfile
+import math
+import datetime
+import xlsxwriter
+import hashlib
+import threading
+import time
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from python_calamine import CalamineWorkbook
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 
 # MongoDB client setup (store connection details in Streamlit secrets)
-client = MongoClient(st.secrets["MONGO_URI"])
+# st.cache_resource shares one client, and its connection pool, across reruns and sessions
+@st.cache_resource
+def get_mongo_client():
+    return MongoClient(st.secrets["MONGO_URI"], server_api=ServerApi('1'), maxPoolSize=50, retryWrites=True, compressors='zstd')
+
+client = get_mongo_client()
 db = client["TestDB"]
 users_collection = db["users"]
-feedback_collection = db["feedback"]
+# Feedback is best-effort, so its writes are unacknowledged (w=0) and don't wait on a round-trip
+feedback_collection = db.get_collection("feedback", write_concern=WriteConcern(w=0))
+
+# Unique index on email: indexed lookups and no duplicate registrations
+@st.cache_resource
+def ensure_user_index():
+    users_collection.create_index("email", unique=True)
+
+try:
+    ensure_user_index()
+except OperationFailure as e:
+    # Usually duplicate emails already stored; remove them so the index can be built (retried on the next run)
+    st.error(f"Could not create the unique index on user emails: {e}")
 
 # Initialize session state for selected sheets
 if "selected_sheets" not in st.session_state:
     st.session_state.selected_sheets = {}
 
+# Initialize session state for authentication
+if "authenticated" not in st.session_state:
+    st.session_state.authenticated = False
+
 # Function to reset selections
 def reset_selections():
     st.session_state.selected_sheets.clear()
 
+# Function to log the current user out
+def logout_user():
+    st.session_state.authenticated = False
+    st.session_state.pop("user_email", None)
+
 # -------------- Utility Functions --------------
 
+# Seconds an idle SMTP connection is kept before it is re-opened
+SMTP_IDLE_TIMEOUT = 60
+
+# Close the pooled SMTP connection, ignoring errors from an already dropped socket
+def close_smtp(pool):
+    if pool["smtp"] is not None:
+        try:
+            pool["smtp"].quit()
+        except Exception:
+            pass
+        pool["smtp"] = None
+
+# Shared SMTP connection state; st.cache_resource keeps it alive across reruns and sessions
+@st.cache_resource
+def get_smtp_pool():
+    pool = {"lock": threading.Lock(), "smtp": None, "last_used": 0.0}
+    atexit.register(close_smtp, pool)
+    return pool
+
+# Return a logged-in SMTP connection, reusing the pooled one while it is fresh and healthy
+def get_smtp_connection(pool):
+    smtp = pool["smtp"]
+    if smtp is not None and time.time() - pool["last_used"] < SMTP_IDLE_TIMEOUT:
+        try:
+            if smtp.noop()[0] == 250:
+                return smtp
+        except Exception:
+            pass
+    close_smtp(pool)
+    smtp = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+    try:
+        smtp.login(st.secrets["EMAIL_USER"], st.secrets["EMAIL_PASS"])
+    except Exception:
+        smtp.close()  # The connection never reaches the pool, so close it here
+        raise
+    pool["smtp"] = smtp
+    return smtp
+
+# Seconds each OTP time window lasts; a code stays valid for the current and previous window
+OTP_PERIOD = 300
+
+# Derive a 6-digit OTP for an email and time window from the server secret, so nothing is stored per OTP
+def issue_otp_at(email, window):
+    digest = hmac.new(st.secrets["OTP_SECRET"].encode(), f"{email}|{window}".encode(), hashlib.sha256).digest()
+    return f"{int.from_bytes(digest[:8], 'big') % 1_000_000:06d}"
+
+# Issue the OTP for the current time window
+def issue_otp(email):
+    return issue_otp_at(email, int(time.time() // OTP_PERIOD))
+
+# Verify an OTP against the current and previous time windows
+def verify_otp(email, otp):
+    window = int(time.time() // OTP_PERIOD)
+    # Compare bytes: compare_digest rejects str input with non-ASCII characters
+    return any(hmac.compare_digest(otp.encode(), issue_otp_at(email, window - age).encode()) for age in (0, 1))
+
 # Send OTP for email verification
 def send_otp(email, otp):
     msg = EmailMessage()
@@ -32,78 +132,419 @@ def send_otp(email, otp):
     msg['To'] = email
 
     try:
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-            smtp.login(st.secrets["EMAIL_USER"], st.secrets["EMAIL_PASS"])
-            smtp.send_message(msg)
+        pool = get_smtp_pool()
+        with pool["lock"]:
+            try:
+                get_smtp_connection(pool).send_message(msg)
+                pool["last_used"] = time.time()
+            except Exception:
+                close_smtp(pool)  # Don't hand a broken connection to the next send
+                raise
         st.success(f"OTP sent to {email}")
     except Exception as e:
         st.error(f"Error sending OTP: {str(e)}")
 
+# bcrypt only uses the first 72 bytes of a password (bcrypt >= 5 raises for longer ones)
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
+# Whether a password is too long to be hashed with bcrypt
+def password_too_long(password):
+    return len(password.encode()) > BCRYPT_MAX_PASSWORD_BYTES
+
+# Hash a password for storage
+def hash_password(password):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+
+# Check a password against a stored value (bcrypt hash, or plaintext from before hashing was added)
+def check_password(password, stored):
+    if isinstance(stored, str):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    # Longer passwords can't have been registered; older bcrypt truncated to 72 bytes, so compare that prefix
+    return bcrypt.checkpw(password.encode()[:BCRYPT_MAX_PASSWORD_BYTES], stored)
+
 # Authenticate user via MongoDB
 def authenticate_user(email, password):
-    user = users_collection.find_one({"email": email, "password": password})
-    return user is not None
+    user = users_collection.find_one({"email": email}, {"password": 1})
+    if user is None or not check_password(password, user["password"]):
+        return False
+    if isinstance(user["password"], str) and not password_too_long(password):
+        # Upgrade a legacy plaintext password to a bcrypt hash
+        users_collection.update_one({"_id": user["_id"]}, {"$set": {"password": hash_password(password)}})
+    return True
 
 # Register a new user
 def register_user(email, password):
-    existing_user = users_collection.find_one({"email": email})
-    if existing_user:
-        st.error("User already exists.")
-    else:
-        users_collection.insert_one({"email": email, "password": password})
+    if password_too_long(password):
+        st.error(f"Password must be at most {BCRYPT_MAX_PASSWORD_BYTES} bytes long.")
+        return
+    try:
+        users_collection.insert_one({"email": email, "password": hash_password(password)})
         st.success("Registration successful.")
+    except DuplicateKeyError:
+        st.error("User already exists.")
 
 # Change user password
 def change_password(email, old_password, new_password):
-    user = users_collection.find_one({"email": email, "password": old_password})
-    if user:
-        users_collection.update_one({"email": email}, {"$set": {"password": new_password}})
-        st.success("Password changed successfully.")
+    if password_too_long(new_password):
+        st.error(f"Password must be at most {BCRYPT_MAX_PASSWORD_BYTES} bytes long.")
+        return
+    user = users_collection.find_one({"email": email}, {"password": 1})
+    if user and check_password(old_password, user["password"]):
+        # Filter on the verified hash so the write only lands if nobody changed the password since the read
+        result = users_collection.update_one({"_id": user["_id"], "password": user["password"]}, {"$set": {"password": hash_password(new_password)}})
+        if result.modified_count:
+            st.success("Password changed successfully.")
+        else:
+            st.error("Password was changed in the meantime. Please try again.")
     else:
         st.error("Invalid email or old password.")
 
-# Consolidation logic for combining CSV/Excel files or specific sheets
-def consolidate_files(file_list, file_type):
-    consolidated_data = pd.DataFrame()
+# Upper bound on parser threads used during consolidation
+MAX_PARSE_WORKERS = 8
+
+# Run parse tasks on a thread pool; pandas' readers spend most of their time outside the GIL
+def run_parse_tasks(parse, tasks):
+    if not tasks:
+        return []
+    with ThreadPoolExecutor(max_workers=min(MAX_PARSE_WORKERS, len(tasks))) as executor:
+        return list(executor.map(parse, tasks))
+
+# Report failed parses from the script thread (Streamlit elements can't be created from workers)
+def collect_frames(results):
+    dfs = []
+    for df, error in results:
+        if error:
+            st.error(error)
+        else:
+            dfs.append(df)
+    return dfs
+
+# Concatenate frames once, adding their labels as categorical columns at the end (one code per row instead of a string)
+def concat_labelled(labelled_frames, names):
+    if not labelled_frames:
+        return pd.DataFrame()
+    keys, dfs = zip(*labelled_frames)
+    dfs = [df.drop(columns=names, errors='ignore') for df in dfs]  # Label columns from an earlier consolidation are replaced
+    consolidated = pd.concat(dfs, keys=list(keys), names=names + [None])
+    consolidated = consolidated.reset_index(level=names).reset_index(drop=True)
+    for name in names:
+        consolidated[name] = consolidated.pop(name).astype('category')
+    return consolidated
+
+# Suffix repeated column names with .1, .2, ... as pandas' C parser does; the pyarrow engine keeps duplicates
+def dedupe_columns(columns):
+    counts, used, renamed = {}, set(), []
+    for column in columns:
+        name = column
+        while name in used:
+            counts[column] = counts.get(column, 0) + 1
+            name = f"{column}.{counts[column]}"
+        used.add(name)
+        renamed.append(name)
+    return renamed
+
+# Snapshot uploads as (name, bytes) pairs; workers get plain bytes instead of sharing UploadedFile cursors
+def read_payloads(uploaded_files):
+    return [(uf.name, uf.getvalue()) for uf in uploaded_files]
+
+# Cache key for a batch of uploads: (name, content hash) per file
+def upload_key(payloads):
+    return tuple((name, hashlib.sha1(data).hexdigest()) for name, data in payloads)
+
+# Sheet names of a workbook, cached on its bytes so reruns don't reopen it
+@st.cache_data(show_spinner=False)
+def get_sheet_names(file_bytes):
+    return CalamineWorkbook.from_filelike(io.BytesIO(file_bytes)).sheet_names
+
+# Number of parsed sheets kept in the sheet cache
+SHEET_CACHE_ENTRIES = 64
+
+# Parsed sheets keyed by (workbook hash, sheet name) in LRU order, shared across reruns and sessions
+@st.cache_resource
+def get_sheet_cache():
+    return {"lock": threading.Lock(), "frames": OrderedDict()}
+
+# Parse several sheets of a workbook, reading only the uncached ones in a single pass
+def read_sheets(file_bytes, sheets):
+    cache = get_sheet_cache()
+    digest = hashlib.sha1(file_bytes).hexdigest()
+    with cache["lock"]:
+        frames = {sheet: cache["frames"][(digest, sheet)] for sheet in sheets if (digest, sheet) in cache["frames"]}
+        for sheet in frames:
+            cache["frames"].move_to_end((digest, sheet))
+
+    missing_sheets = [sheet for sheet in sheets if sheet not in frames]
+    if missing_sheets:
+        parsed = pd.read_excel(io.BytesIO(file_bytes), sheet_name=missing_sheets, engine='calamine')
+        with cache["lock"]:
+            for sheet, sheet_df in parsed.items():
+                cache["frames"][(digest, sheet)] = sheet_df
+            while len(cache["frames"]) > SHEET_CACHE_ENTRIES:
+                cache["frames"].popitem(last=False)  # Evict the least recently used sheet
+        frames.update(parsed)
+
+    return {sheet: frames[sheet] for sheet in sheets}
+
+# Read a CSV with the multithreaded pyarrow engine, falling back to the C engine for files it rejects (e.g. ragged rows)
+def read_csv_frame(data):
+    try:
+        df = pd.read_csv(io.BytesIO(data), engine='pyarrow', dtype_backend='pyarrow')
+    except (pd.errors.ParserError, pa.ArrowInvalid):
+        return pd.read_csv(io.BytesIO(data), engine='c', dtype_backend='pyarrow')  # Pads short rows and renames duplicate headers itself
+    if df.columns.has_duplicates:
+        df.columns = dedupe_columns(df.columns)
+    return df
 
-    for uploaded_file in file_list:
+# Consolidation logic for combining CSV/Excel files or specific sheets
+def consolidate_files(payloads, file_type):
+    def parse(payload):
+        name, data = payload
         try:
             if file_type == 'csv':
-                df = pd.read_csv(uploaded_file)
-                df['Filename'] = uploaded_file.name  # Add filename column
-                consolidated_data = pd.concat([consolidated_data, df], ignore_index=True)
-            elif file_type == 'excel':
-                df = pd.read_excel(uploaded_file, engine='openpyxl')
-                df['Filename'] = uploaded_file.name  # Add filename column
-                consolidated_data = pd.concat([consolidated_data, df], ignore_index=True)
+                df = read_csv_frame(data)
+            else:
+                df = pd.read_excel(io.BytesIO(data), engine='calamine')
+            return (name, df), None
         except ValueError as e:
-            st.error(f"Error processing {uploaded_file.name}: {e}")
+            return None, f"Error processing {name}: {e}"
         except Exception as e:
-            st.error(f"Unexpected error with file {uploaded_file.name}: {e}")
+            return None, f"Unexpected error with file {name}: {e}"
 
-    return consolidated_data
+    labelled_frames = collect_frames(run_parse_tasks(parse, payloads))
+    return concat_labelled(labelled_frames, ['Filename'])
 
-# Consolidation logic for sheets
-def consolidate_sheets(file_list, selected_sheets):
-    consolidated_data = pd.DataFrame()
+# Number of consolidated results kept per cache; each one holds a full DataFrame
+CONSOLIDATION_CACHE_ENTRIES = 4
+
+# Cached file consolidation; the upload key stands in for hashing every payload
+@st.cache_data(show_spinner="Consolidating files...", max_entries=CONSOLIDATION_CACHE_ENTRIES)
+def consolidate_files_cached(key, _payloads, file_type):
+    return consolidate_files(_payloads, file_type)
+
+# Parse one upload straight to an Arrow table (without the filename column, which conform_table adds)
+def read_arrow_table(data, file_type):
+    if file_type == 'csv':
+        try:
+            table = pa_csv.read_csv(io.BytesIO(data))
+            table = table.rename_columns(dedupe_columns(table.column_names))
+        except pa.ArrowInvalid:
+            # Same fallback as read_csv_frame for files the Arrow reader rejects
+            table = pa.Table.from_pandas(pd.read_csv(io.BytesIO(data), engine='c', dtype_backend='pyarrow'), preserve_index=False)
+    else:
+        df = pd.read_excel(io.BytesIO(data), engine='calamine')
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Object columns mixing numbers and text have no single Arrow type; read them as text
+            table = pa.Table.from_pandas(df.astype({column: 'string' for column in df.select_dtypes(include='object').columns}), preserve_index=False)
+    return table.select([column for column in table.column_names if column != 'Filename'])  # An earlier Filename column is replaced
+
+# Merge per-file schemas into the output schema, widening types (null -> any, int -> float) and falling back to text
+def merge_schemas(schemas):
+    column_types = {}
+    for schema in schemas:
+        for field in schema:
+            column_types.setdefault(field.name, []).append(field.type)
+
+    fields = []
+    for column, types in column_types.items():
+        try:
+            merged = pa.unify_schemas([pa.schema([pa.field(column, column_type)]) for column_type in types], promote_options='permissive')
+            fields.append(merged.field(column))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields + [pa.field('Filename', pa.string())])
+
+# Match a table to the output schema, filling columns it lacks with nulls and adding its filename
+def conform_table(table, name, schema):
+    columns = [table[field.name] if field.name in table.column_names else pa.nulls(table.num_rows, field.type) for field in schema if field.name != 'Filename']
+    columns.append(pa.array([name] * table.num_rows, pa.string()))
+    return pa.table(columns, names=schema.names).cast(schema)
+
+# Consolidate files into a single Parquet file, holding only one parsed file in memory at a time
+def stream_files_to_parquet(payloads, file_type):
+    with tempfile.TemporaryDirectory() as spill_dir:
+        # First pass: parse each file once and spill it to an Arrow IPC file, keeping only its schema in memory
+        spilled = []  # (name, path, schema) per parsed file, in upload order
+        for index, (name, data) in enumerate(payloads):
+            try:
+                table = read_arrow_table(data, file_type)
+                path = os.path.join(spill_dir, f"{index}.arrow")
+                with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as spill_writer:
+                    spill_writer.write_table(table)
+                spilled.append((name, path, table.schema))
+                del table
+            except ValueError as e:
+                st.error(f"Error processing {name}: {e}")
+            except Exception as e:
+                st.error(f"Unexpected error with file {name}: {e}")
+
+        if not spilled:
+            return None
+
+        # Second pass: memory-map each spilled file, conform it to the merged schema and append it
+        output = io.BytesIO()
+        schema = merge_schemas(file_schema for _, _, file_schema in spilled)
+        with pq.ParquetWriter(output, schema, compression='zstd') as writer:
+            for name, path, _ in spilled:
+                try:
+                    with pa.memory_map(path) as source:
+                        writer.write_table(conform_table(pa.ipc.open_file(source).read_all(), name, schema))
+                except ValueError as e:
+                    st.error(f"Error processing {name}: {e}")
+                except Exception as e:
+                    st.error(f"Unexpected error with file {name}: {e}")
+        return output.getvalue()
+
+# Cached streaming consolidation, keyed like consolidate_files_cached
+@st.cache_data(show_spinner="Consolidating files...", max_entries=CONSOLIDATION_CACHE_ENTRIES)
+def stream_files_to_parquet_cached(key, _payloads, file_type):
+    return stream_files_to_parquet(_payloads, file_type)
 
-    for uploaded_file in file_list:
+# Consolidation logic for sheets
+def consolidate_sheets(payloads, selected_sheets):
+    def parse(task):
+        name, data, sheets = task
         try:
-            if uploaded_file.name in selected_sheets:
-                for sheet in selected_sheets[uploaded_file.name]:
-                    sheet_df = pd.read_excel(uploaded_file, sheet_name=sheet)
-                    sheet_df['Filename'] = uploaded_file.name  # Add filename column
-                    sheet_df['Sheet Name'] = sheet  # Add sheet name column
-                    consolidated_data = pd.concat([consolidated_data, sheet_df], ignore_index=True)
+            frames = read_sheets(data, tuple(sheets))
+            return [((name, sheet), sheet_df) for sheet, sheet_df in frames.items()], None
         except ValueError as e:
-            st.error(f"Error processing sheet in {uploaded_file.name}: {e}")
+            return None, f"Error processing sheet in {name}: {e}"
         except Exception as e:
-            st.error(f"Unexpected error with file {uploaded_file.name}: {e}")
+            return None, f"Unexpected error with file {name}: {e}"
+
+    # One task per file, covering all of its selected sheets
+    tasks = [(name, data, selected_sheets[name]) for name, data in payloads if selected_sheets.get(name)]
+    labelled_frames = [frame for frames in collect_frames(run_parse_tasks(parse, tasks)) for frame in frames]
+    return concat_labelled(labelled_frames, ['Filename', 'Sheet Name'])
+
+# Cached sheet consolidation, keyed on the upload key and the selection as ((filename, (sheet, ...)), ...)
+@st.cache_data(show_spinner="Consolidating sheets...", max_entries=CONSOLIDATION_CACHE_ENTRIES)
+def consolidate_sheets_cached(key, _payloads, sheet_selection):
+    return consolidate_sheets(_payloads, dict(sheet_selection))
+
+# Output formats offered for the consolidated download
+OUTPUT_FORMATS = ['xlsx', 'csv', 'parquet']
+
+# Rows available on an Excel worksheet, including the header row
+EXCEL_MAX_ROWS = 1048576
+
+# Map a value to what to_excel would write: blanks for missing values and 'inf'/'-inf' text for infinities
+def xlsx_value(value):
+    if pd.isna(value):
+        return None
+    if isinstance(value, float) and math.isinf(value):
+        return 'inf' if value > 0 else '-inf'
+    return value
+
+# Write an Excel file row by row; constant_memory flushes each row instead of holding every cell
+def write_xlsx(consolidated_data, output):
+    if len(consolidated_data) + 1 > EXCEL_MAX_ROWS:
+        raise ValueError(f"{len(consolidated_data)} rows exceed Excel's limit of {EXCEL_MAX_ROWS - 1} data rows. Download as CSV or Parquet instead.")
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'strings_to_urls': False, 'remove_timezone': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    worksheet = workbook.add_worksheet()
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})  # Same header style as to_excel
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})  # to_excel's format for plain dates
+    worksheet.write_row(0, 0, [str(column) for column in consolidated_data.columns], header_format)
+    for row_num, row in enumerate(consolidated_data.itertuples(index=False, name=None), start=1):
+        for col_num, value in enumerate(row):
+            value = xlsx_value(value)
+            if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+                worksheet.write_datetime(row_num, col_num, value, date_format)
+            else:
+                worksheet.write(row_num, col_num, value)
+    workbook.close()
 
-    return consolidated_data
+# Write a Parquet file; object columns mixing numbers and text have no single Arrow type, so they fall back to text
+def write_parquet(consolidated_data, output):
+    try:
+        consolidated_data.to_parquet(output, index=False, compression='zstd')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        output.seek(0)
+        output.truncate()
+        object_columns = consolidated_data.select_dtypes(include='object').columns
+        consolidated_data.astype({column: 'string' for column in object_columns}).to_parquet(output, index=False, compression='zstd')
+
+# Serialize consolidated data for download in the chosen format
+def export_consolidated(consolidated_data, output_format):
+    output = io.BytesIO()
+    if output_format == 'csv':
+        consolidated_data.to_csv(output, index=False)
+    elif output_format == 'parquet':
+        write_parquet(consolidated_data, output)
+    else:
+        write_xlsx(consolidated_data, output)
+    return output.getvalue()
 
 # -------------- Streamlit Web Interface --------------
 
+# Serialized downloads, cached so re-rendering the download controls doesn't re-export the data
+@st.cache_data(show_spinner="Preparing download...", max_entries=CONSOLIDATION_CACHE_ENTRIES)
+def export_consolidated_cached(key, _consolidated_data, output_format):
+    return export_consolidated(_consolidated_data, output_format)
+
+# Download controls; as a fragment, editing the file name or format reruns only this section
+@st.fragment
+def download_section(key, consolidated_data):
+    # Allow the user to name the consolidated output file
+    output_file_name = st.text_input("Enter name for the consolidated output file (without extension)", value="consolidated")
+
+    # Option to download consolidated file
+    output_format = st.radio("Select output format:", OUTPUT_FORMATS, horizontal=True)
+    try:
+        output_data = export_consolidated_cached(key, consolidated_data, output_format)
+    except (ValueError, TypeError) as e:
+        st.error(f"Error preparing download: {e}")
+    else:
+        st.download_button(label="Download Consolidated File", data=output_data, file_name=f"{output_file_name}.{output_format}")
+
+# Download controls for streamed Parquet output
+@st.fragment
+def parquet_download_section(parquet_data):
+    # Allow the user to name the consolidated output file
+    output_file_name = st.text_input("Enter name for the consolidated output file (without extension)", value="consolidated")
+    st.download_button(label="Download Consolidated File", data=parquet_data, file_name=f"{output_file_name}.parquet")
+
+# Sheet search, selection and consolidation; as a fragment, selection changes rerun only this section
+@st.fragment
+def sheet_consolidation_section(payloads):
+    selected_sheets = st.session_state.selected_sheets  # Maintain state of selected sheets across reruns
+    search_term = st.text_input("Search for sheets (optional)")
+
+    # Load sheet names for all workbooks in parallel (cached per workbook)
+    sheet_name_lists = run_parse_tasks(get_sheet_names, [data for _, data in payloads])
+    all_sheet_names = {name: sheet_names for (name, _), sheet_names in zip(payloads, sheet_name_lists)}
+
+    # Sheets matching the search term in each file
+    search = search_term.lower()
+    matching_sheets = {filename: [sheet for sheet in sheet_names if search and search in sheet.lower()] for filename, sheet_names in all_sheet_names.items()}
+
+    # Show manual sheet selection for each file
+    for filename, sheet_names in all_sheet_names.items():
+        selected_sheets[filename] = st.multiselect(f"Select sheets in {filename} manually:", options=sheet_names, default=selected_sheets.get(filename, []))
+
+    # Automatically select and consolidate sheets matching the search term
+    if any(matching_sheets.values()):
+        st.write(f"Automatically consolidating sheets matching '{search_term}' across all files:")
+        for filename, sheet_names in all_sheet_names.items():
+            # Merge matches into the manual selection without duplicates, keeping workbook order
+            chosen = set(selected_sheets.get(filename, [])) | set(matching_sheets[filename])
+            selected_sheets[filename] = [sheet for sheet in sheet_names if sheet in chosen]
+
+    # Consolidate the selected sheets
+    key = upload_key(payloads)
+    sheet_selection = tuple((name, tuple(selected_sheets[name])) for name, _ in payloads if selected_sheets.get(name))
+    consolidated_data = consolidate_sheets_cached(key, payloads, sheet_selection)
+
+    if not consolidated_data.empty:
+        # Display consolidated data
+        st.write("Consolidated Data from Sheets:")
+        st.dataframe(consolidated_data)
+
+        download_section((key, sheet_selection), consolidated_data)
+    else:
+        st.warning("No data to display after consolidation.")
+
 # Main UI
 st.title('Data Consolidation Tool')
 st.write("Please log in and upload your files for consolidation.")
@@ -126,12 +567,26 @@ elif auth_choice == 'Change Password':
 else:
     if st.button('Login'):
         if authenticate_user(email, password):
+            # Remember the login so reruns don't query MongoDB again
+            st.session_state.authenticated = True
+            st.session_state.user_email = email
             st.success('User logged in successfully!')
         else:
+            # A failed login ends any existing session rather than leaving the previous user signed in
+            logout_user()
             st.error('Invalid email or password.')
 
+# The session belongs to the stored email; the email field above doesn't change who is logged in
+if st.session_state.authenticated:
+    st.write(f"Logged in as {st.session_state.user_email}")
+    if email and email != st.session_state.user_email:
+        st.info(f"The email entered above is not the logged-in account. Uploads and feedback are recorded for {st.session_state.user_email}.")
+    if st.button('Logout'):
+        logout_user()
+        st.success('Logged out successfully.')
+
 # Only show file upload section if user is authenticated
-if authenticate_user(email, password):
+if st.session_state.authenticated:
 
     # 1. Select File Type (Default is Excel)
     st.header('File Consolidation')
@@ -147,87 +602,49 @@ if authenticate_user(email, password):
     # Display total number of uploaded files
     if uploaded_files:
         st.write(f"Total uploaded files: {len(uploaded_files)}")
+        payloads = read_payloads(uploaded_files)
 
         # 4. File Consolidation
         if consolidation_type == "Consolidate data from files":
-            consolidated_data = consolidate_files(uploaded_files, file_type)
+            stream_to_parquet = st.checkbox("Stream straight to Parquet (for uploads too large to preview)")
 
-            if not consolidated_data.empty:
-                # Display consolidated data
-                st.write("Consolidated Data from Files:")
-                st.dataframe(consolidated_data)
+            if stream_to_parquet:
+                parquet_data = stream_files_to_parquet_cached(upload_key(payloads), payloads, file_type)
 
-                # Allow the user to name the consolidated output file
-                output_file_name = st.text_input("Enter name for the consolidated output file (without extension)", value="consolidated")
-
-                # Option to download consolidated file
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    consolidated_data.to_excel(writer, index=False)
-                st.download_button(label="Download Consolidated File", data=output.getvalue(), file_name=f"{output_file_name}.xlsx")
+                if parquet_data is not None:
+                    parquet_download_section(parquet_data)
+                else:
+                    st.warning("No data to display after consolidation.")
             else:
-                st.warning("No data to display after consolidation.")
+                key = upload_key(payloads)
+                consolidated_data = consolidate_files_cached(key, payloads, file_type)
+
+                if not consolidated_data.empty:
+                    # Display consolidated data
+                    st.write("Consolidated Data from Files:")
+                    st.dataframe(consolidated_data)
+
+                    download_section((key, file_type), consolidated_data)
+                else:
+                    st.warning("No data to display after consolidation.")
 
         # 5. Sheet Selection for Sheet Consolidation
         elif consolidation_type == "Consolidate data from sheets" and file_type == 'excel':
-            selected_sheets = st.session_state.selected_sheets  # Maintain state of selected sheets across reruns
-            search_term = st.text_input("Search for sheets (optional)")
-
-            # List to store all matching sheets across all files for the search term
-            global_matching_sheets = []
-
-            for file in uploaded_files:
-                sheet_names = pd.ExcelFile(file).sheet_names  # Load sheet names
-
-                # Show manual sheet selection for each file
-                selected_sheets[file.name] = st.multiselect(f"Select sheets in {file.name} manually:", options=sheet_names, default=selected_sheets.get(file.name, []))
-
-                # Apply search query to filter sheets
-                filtered_sheets = [sheet for sheet in sheet_names if search_term.lower() in sheet.lower()]
-
-                # Store sheets matching the search term globally (filename - sheet name format)
-                for sheet in filtered_sheets:
-                    global_matching_sheets.append((file.name, sheet))
-
-            # Automatically select and consolidate sheets matching the search term
-            if search_term and global_matching_sheets:
-                st.write(f"Automatically consolidating sheets matching '{search_term}' across all files:")
-                for filename, sheet_name in global_matching_sheets:
-                    if filename not in selected_sheets:
-                        selected_sheets[filename] = []
-                    selected_sheets[filename].append(sheet_name)
-
-            # Consolidate the selected sheets
-            mapped_sheets = {file.name: selected_sheets[file.name] for file in uploaded_files if selected_sheets.get(file.name)}
-            consolidated_data = consolidate_sheets(uploaded_files, mapped_sheets)
-
-            if not consolidated_data.empty:
-                # Display consolidated data
-                st.write("Consolidated Data from Sheets:")
-                st.dataframe(consolidated_data)
-
-                # Allow the user to name the consolidated output file
-                output_file_name = st.text_input("Enter name for the consolidated output file (without extension)", value="consolidated")
-
-                # Option to download consolidated file
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    consolidated_data.to_excel(writer, index=False)
-                st.download_button(label="Download Consolidated File", data=output.getvalue(), file_name=f"{output_file_name}.xlsx")
-            else:
-                st.warning("No data to display after consolidation.")
+            sheet_consolidation_section(payloads)
 
         # Add Reset Button to Clear Selections
         if st.button("Reset Selections"):
             reset_selections()
             st.success("Selections have been reset.")
 
-    # Feedback section after consolidation
-    st.write("Please provide feedback for the consolidation process:")
-    feedback = st.text_area("Enter your feedback:")
-    
-    if st.button("Submit Feedback"):
-        feedback_collection.insert_one({"email": email, "feedback": feedback})
+    # Feedback section after consolidation; the form only reruns the app on submit
+    with st.form("feedback_form", clear_on_submit=True):
+        st.write("Please provide feedback for the consolidation process:")
+        feedback = st.text_area("Enter your feedback:")
+        feedback_submitted = st.form_submit_button("Submit Feedback")
+
+    if feedback_submitted:
+        feedback_collection.insert_one({"email": st.session_state.user_email, "feedback": feedback})
         st.success("Feedback submitted successfully!")
 
 # Inject Custom CSS for Fixed Footer